@@ -5,11 +5,14 @@ import sys
 import psycopg
 import os
 import re
+import time
+from datetime import datetime
 from contextlib import AsyncExitStack
 from typing import Optional
 from dotenv import load_dotenv
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+from mcp.types import ServerNotification, ToolListChangedNotification
 from google import genai
 from google.genai import types
 
@@ -21,6 +24,78 @@ DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_PORT = os.getenv("DB_PORT")
 
+SYSTEM_INSTRUCTION = "You are fAfAfIfI, a workout assistant bot, only answer workout related question and combine your answer with available tools, You can use external tools from the MCP server to improve your answers, You can use multiple external tools from the MCP server in one answer. Write each tool call on a new line, exactly in this format: @tool:tool_name(arg1=value1,arg2=value2). You may call multiple tools if the query needs multiple data sources. Always answer in plain text and don't use markdown format"
+
+SAFETY_SETTINGS = [
+    types.SafetySetting(
+        category=category,
+        threshold=types.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
+    )
+    for category in [
+        types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+        types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+        types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+        types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT
+    ]
+]
+
+# Cached context lifetime in seconds, recreated a bit before Gemini expires it
+CACHE_TTL = 3600
+CACHE_REFRESH_MARGIN = 60
+# Seconds to wait before retrying after a transient cache creation error
+CACHE_RETRY_BACKOFF = 300
+
+# Example queries per intent, embedded once and matched by nearest neighbor.
+# "chain" holds near misses that must go through the full chain.
+INTENT_EXAMPLES = {
+    "time": [
+        "what time is it",
+        "what time is it in Jakarta",
+        "what is the current time in Yogyakarta",
+        "jam berapa sekarang",
+    ],
+    "weather": [
+        "what is the weather in Yogyakarta",
+        "should I run in Yogyakarta now",
+        "is it good to run outside in Jakarta now",
+        "is it raining in Bandung right now",
+    ],
+    "chain": [
+        "should I run in Yogyakarta now or do a gym session instead",
+        "best running route in Jakarta",
+        "what workout should I do today",
+        "gym recommendation around Yogyakarta",
+        "how long should I rest between sets",
+        "is it safe to run with a knee injury",
+    ],
+}
+INTENT_THRESHOLD = 0.8
+
+CITY_TIMEZONES = {
+    "jakarta": "Asia/Jakarta",
+    "yogyakarta": "Asia/Jakarta",
+    "jogja": "Asia/Jakarta",
+    "bandung": "Asia/Jakarta",
+    "semarang": "Asia/Jakarta",
+    "surabaya": "Asia/Jakarta",
+    "medan": "Asia/Jakarta",
+    "palembang": "Asia/Jakarta",
+    "pontianak": "Asia/Pontianak",
+    "denpasar": "Asia/Makassar",
+    "bali": "Asia/Makassar",
+    "makassar": "Asia/Makassar",
+    "balikpapan": "Asia/Makassar",
+    "manado": "Asia/Makassar",
+    "ambon": "Asia/Jayapura",
+    "jayapura": "Asia/Jayapura",
+}
+
+# Queries about another day need forecasts, leave those to the full chain
+FORECAST_PATTERN = re.compile(r"\b(tomorrow|tonight|later|next|monday|tuesday|wednesday|thursday|friday|saturday|sunday|besok|forecast)\b", re.IGNORECASE)
+
+# Places are only taken from "in <city>" / "at <city>" / "di <city>"
+PLACE_PATTERN = re.compile(r"\b(?:in|at|di)\s+([a-z]+)")
+
 
 # Convert TextContent objects into plain text
 def extract_text(content_list):
@@ -65,10 +140,31 @@ class MCPClient:
         self.exit_stack = AsyncExitStack()
         self.genai_client = genai.Client()
         self.tools = []
+        self.tools_signature = None
+        self.tools_stale = True
         self.memory = []
+        self.cache_name = None
+        self.cache_signature = None
+        self.cache_expires_at = 0.0
+        self.cache_failed_signature = None
+        self.cache_retry_at = 0.0
+        self.intent_embeddings = None
+        self.route_counts = {"time": 0, "weather": 0, "chain": 0}
+
+    def generate(self, label, **kwargs):
+        """Call Gemini and report input token count and latency for the call."""
+        start = time.perf_counter()
+        response = self.genai_client.models.generate_content(**kwargs)
+        latency = time.perf_counter() - start
+        usage = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(usage, "prompt_token_count", None)
+        cached_tokens = getattr(usage, "cached_content_token_count", None) or 0
+        print(f"📊 {label}: {prompt_tokens} input tokens ({cached_tokens} cached), {latency:.2f}s")
+        return response
 
     async def process_output(self, output, channel_id = "cli"):
-        summary = self.genai_client.models.generate_content(
+        summary = self.generate(
+            "summary",
             model="gemini-2.5-flash",
             contents=(
                 f"""
@@ -146,6 +242,13 @@ class MCPClient:
         )
         return result.embeddings[0].values
 
+    async def embed_results(self, texts):
+        result = self.genai_client.models.embed_content(
+            model="models/text-embedding-004",
+            contents=texts
+        )
+        return [embedding.values for embedding in result.embeddings]
+
     async def connect_to_server(self, server_script_path: str):
         """Connect to an MCP server."""
         if not server_script_path.endswith(".py"):
@@ -159,10 +262,26 @@ class MCPClient:
 
         stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
         self.stdio, self.write = stdio_transport
-        self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
+        self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write, message_handler=self.handle_message))
 
         await self.session.initialize()
+        await self.sync_tools()
+        try:
+            await self.load_intent_embeddings()
+        except Exception as e:
+            print(f"⚠️ Intent embedding failed, retrying on next query: {e}")
+
+    async def handle_message(self, message):
+        """Mark the tool list stale when the MCP server announces a change."""
+        if isinstance(message, ServerNotification) and isinstance(message.root, ToolListChangedNotification):
+            self.tools_stale = True
+
+    async def sync_tools(self):
+        """Reload tool declarations from the MCP server and invalidate the cache if they changed."""
+        if self.session is None:
+            return
         response = await self.session.list_tools()
+        self.tools_stale = False
 
         function_declarations = []
         for tool in response.tools:
@@ -172,11 +291,145 @@ class MCPClient:
                 "parameters": tool.inputSchema,
             }
             function_declarations.append(func)
+
+        signature = json.dumps(function_declarations, sort_keys=True, default=str)
+        if signature == self.tools_signature:
+            return
         self.tools = [types.Tool(function_declarations=function_declarations)]
+        self.tools_signature = signature
+        self.delete_cache()
+
+    def get_cache(self):
+        """Return the cached context name for the system instruction and tools, creating it if needed."""
+        if not self.tools or self.tools_signature is None:
+            return None
+        # Wall clock rather than monotonic so time spent suspended counts towards expiry
+        now = time.time()
+        if self.cache_name and self.cache_signature == self.tools_signature and now < self.cache_expires_at:
+            return self.cache_name
+        if self.cache_failed_signature == self.tools_signature or now < self.cache_retry_at:
+            return None
+
+        self.delete_cache()
+        try:
+            cache = self.genai_client.caches.create(
+                model="gemini-2.5-flash",
+                config=types.CreateCachedContentConfig(
+                    display_name="fafafifi-system",
+                    system_instruction=SYSTEM_INSTRUCTION,
+                    tools=self.tools,
+                    ttl=f"{CACHE_TTL}s",
+                ),
+            )
+        except Exception as e:
+            print(f"⚠️ Context cache creation failed: {e}")
+            if "too small" in str(e).lower() or "min_total_token_count" in str(e):
+                # Gemini's minimum size error is permanent for this tool set
+                self.cache_failed_signature = self.tools_signature
+            else:
+                self.cache_retry_at = now + CACHE_RETRY_BACKOFF
+            return None
+
+        expire_time = getattr(cache, "expire_time", None)
+        expires_at = expire_time.timestamp() if isinstance(expire_time, datetime) else now + CACHE_TTL
+        self.cache_name = cache.name
+        self.cache_signature = self.tools_signature
+        self.cache_expires_at = expires_at - CACHE_REFRESH_MARGIN
+        return self.cache_name
+
+    def delete_cache(self):
+        """Drop the current cached context, if any."""
+        if self.cache_name is None:
+            return
+        try:
+            self.genai_client.caches.delete(name=self.cache_name)
+        except Exception as e:
+            print(f"⚠️ Context cache deletion failed: {e}")
+        self.cache_name = None
+        self.cache_signature = None
+        self.cache_expires_at = 0.0
+
+    async def load_intent_embeddings(self):
+        """Embed the intent examples once, in a single batched call, for the local router."""
+        if self.intent_embeddings is None:
+            labelled = [(intent, example) for intent, examples in INTENT_EXAMPLES.items() for example in examples]
+            embeddings = await self.embed_results([example for _, example in labelled])
+            self.intent_embeddings = [(intent, embedding) for (intent, _), embedding in zip(labelled, embeddings)]
+        return self.intent_embeddings
+
+    async def route_query(self, query, query_embedding, has_memories=False):
+        """Match a query to a fast-path intent and return the tool calls it needs, or None."""
+        if query_embedding is None or self.session is None or FORECAST_PATTERN.search(query):
+            return None
+
+        best_intent, best_score = None, -1.0
+        for intent, embedding in await self.load_intent_embeddings():
+            similarity = cosine_similarity(embedding, query_embedding)
+            if similarity > best_score:
+                best_intent, best_score = intent, similarity
+        if best_intent == "chain" or best_score < INTENT_THRESHOLD:
+            return None
+
+        lowered = query.lower()
+        places = PLACE_PATTERN.findall(lowered)
+        mentioned = [c for c in CITY_TIMEZONES if re.search(rf"\b{c}\b", lowered)]
+        # Unknown places and comparisons between cities need the full chain
+        if len(places) > 1 or len(mentioned) > 1 or any(p not in CITY_TIMEZONES for p in places):
+            return None
+        # A single known city named without a preposition ("Makassar time now") still counts
+        city = places[0] if places else (mentioned[0] if mentioned else None)
+
+        if city is None:
+            # No city anywhere in the query; memories may hold the user's city, so only default when there are none
+            if best_intent != "time" or has_memories:
+                return None
+            return best_intent, [("get_current_time", {})]
+        if best_intent == "time":
+            return best_intent, [("get_current_time", {"location": CITY_TIMEZONES[city]})]
+        return best_intent, [
+            ("get_current_weather", {"location": city.title()}),
+            ("get_current_time", {"location": CITY_TIMEZONES[city]}),
+        ]
+
+    async def call_tools(self, calls):
+        """Call MCP tools and collect their results."""
+        tool_results = []
+        for tool_name, json_args in calls:
+            try:
+                tool_result = await self.session.call_tool(tool_name, json_args)
+                tool_results.append({
+                    "tool": tool_name,
+                    "args": json_args,
+                    "result": extract_text(tool_result.content)
+                })
+            except Exception as e:
+                print(f"❌ Error calling tool '{tool_name}': {e}")
+        return tool_results
+
+    def summarize_tool_results(self, label, query, tool_results):
+        combined_summary = json.dumps(tool_results, ensure_ascii=False)
+        follow_up = self.generate(
+            label,
+            model="gemini-2.5-flash",
+            contents=(
+                f"User query: {query}\n\n"
+                f"Tool results: {combined_summary}\n\n"
+                "Summarize the combined results into a coherent workout-related answer with plain text answer and don't use markdown format."
+            ),
+        )
+        return follow_up.text.strip()
+
+    def count_route(self, route):
+        self.route_counts[route] += 1
+        total = sum(self.route_counts.values())
+        fast = total - self.route_counts["chain"]
+        counts = ", ".join(f"{name}={count}" for name, count in self.route_counts.items())
+        print(f"🧭 Route: {route} ({counts}, fast path {fast}/{total})")
 
     async def process_query(self, query: str, channel_id="cli") -> str:
         """Send query to Gemini, detect tool use, and store relevant memories."""
         # === Retrieve similar LTM ===
+        query_embedding = None
         try:
             query_embedding = await self.embed_result(query)
             ltm = await self.fetch_ltm(channel_id, query_embedding)
@@ -185,10 +438,25 @@ class MCPClient:
             ltm = []
         relevant_ltm = "\n".join(ltm)
 
+        # === Fast path for simple time/weather queries ===
+        try:
+            route = await self.route_query(query, query_embedding, bool(self.memory or ltm))
+        except Exception as e:
+            print(f"⚠️ Intent routing failed: {e}")
+            route = None
+        if route:
+            intent, calls = route
+            tool_results = await self.call_tools(calls)
+            if tool_results:
+                self.count_route(intent)
+                return self.summarize_tool_results("fast_path", query, tool_results)
+        self.count_route("chain")
+
         if self.memory:
             stm = [m[1] for m in self.memory]
             relevant_stm = "\n".join(stm)
-            context = self.genai_client.models.generate_content(
+            context = self.generate(
+                "context",
                 model="gemini-2.5-flash",
                 contents=f"Summarize '{relevant_stm}' into something like 'Running in Yogyakarta now' or 'Workout for beginner' or 'Outdoor workout for tomorrow' that is relevant to query {query}, always add city, name, place, time, situation, or activity name if it's included in memories, only include the summary and don't add anything else",
                 config=types.GenerateContentConfig(
@@ -200,7 +468,8 @@ class MCPClient:
             
         query = f"User query: {query}\nContext: {context}\nRelevant memories: {relevant_ltm}"
         
-        query = self.genai_client.models.generate_content(
+        query = self.generate(
+            "rewrite",
             model="gemini-2.5-flash",
             contents=f"Combine {query} into one complete query, only include the query and don't add anything",
             config=types.GenerateContentConfig(
@@ -209,62 +478,57 @@ class MCPClient:
         ).text.strip()
 
         # === Call Gemini ===
-        llm_response = self.genai_client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=query,
-            config=types.GenerateContentConfig(
-                system_instruction=(
-                    "You are fAfAfIfI, a workout assistant bot, only answer workout related question and combine your answer with available tools, You can use external tools from the MCP server to improve your answers, You can use multiple external tools from the MCP server in one answer. Write each tool call on a new line, exactly in this format: @tool:tool_name(arg1=value1,arg2=value2). You may call multiple tools if the query needs multiple data sources. Always answer in plain text and don't use markdown format",
-                ),
-                thinking_config=types.ThinkingConfig(thinking_budget=20),
-                safety_settings=[
-                    types.SafetySetting(
-                        category=category,
-                        threshold=types.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-                    )
-                    for category in [
-                        types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                        types.HarmCategory.HARM_CATEGORY_HARASSMENT,
-                        types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                        types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT
-                    ]
-                ],
-                tools=self.tools
-            ),
+        if self.tools_stale:
+            try:
+                await self.sync_tools()
+            except Exception as e:
+                print(f"⚠️ Tool list refresh failed, keeping current tools: {e}")
+        inline_config = types.GenerateContentConfig(
+            system_instruction=SYSTEM_INSTRUCTION,
+            thinking_config=types.ThinkingConfig(thinking_budget=20),
+            safety_settings=SAFETY_SETTINGS,
+            tools=self.tools
         )
+        cache_name = self.get_cache()
+        if cache_name:
+            try:
+                llm_response = self.generate(
+                    "main",
+                    model="gemini-2.5-flash",
+                    contents=query,
+                    config=types.GenerateContentConfig(
+                        cached_content=cache_name,
+                        thinking_config=types.ThinkingConfig(thinking_budget=20),
+                        safety_settings=SAFETY_SETTINGS,
+                    ),
+                )
+            except Exception as e:
+                # The cache may have expired or been deleted on Gemini's side
+                print(f"⚠️ Cached call failed, retrying inline: {e}")
+                self.delete_cache()
+                cache_name = None
+        if not cache_name:
+            llm_response = self.generate(
+                "main",
+                model="gemini-2.5-flash",
+                contents=query,
+                config=inline_config,
+            )
 
         candidate = llm_response.candidates[0]
         content_parts = candidate.content.parts if candidate.content.parts else None
-        tool_results = []
 
         # === Execute any tool calls ===
-        for part in content_parts or []:
-            if hasattr(part, "function_call") and part.function_call:
-                fn = part.function_call
-                tool_name = fn.name
-                json_args = fn.args or {}
-                try:
-                    tool_result = await self.session.call_tool(tool_name, json_args)
-                    tool_results.append({
-                        "tool": tool_name,
-                        "args": json_args,
-                        "result": extract_text(tool_result.content)
-                    })
-                except Exception as e:
-                    print(f"❌ Error calling tool '{tool_name}': {e}")
+        calls = [
+            (part.function_call.name, part.function_call.args or {})
+            for part in content_parts or []
+            if hasattr(part, "function_call") and part.function_call
+        ]
+        tool_results = await self.call_tools(calls)
 
         # === Summarize tool results ===
         if tool_results:
-            combined_summary = json.dumps(tool_results, ensure_ascii=False)
-            follow_up = self.genai_client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=(
-                    f"User query: {query}\n\n"
-                    f"Tool results: {combined_summary}\n\n"
-                    "Summarize the combined results into a coherent workout-related answer with plain text answer and don't use markdown format."
-                ),
-            )
-            return follow_up.text.strip()
+            return self.summarize_tool_results("follow_up", query, tool_results)
 
         # === Fallback text ===
         if llm_response.text:
@@ -293,6 +557,7 @@ class MCPClient:
                 print(f"❌ Error: {e}")
 
     async def cleanup(self):
+        self.delete_cache()
         await self.exit_stack.aclose()
 
 
@@ -4,6 +4,7 @@ from unittest.mock import AsyncMock, MagicMock, patch
 import asyncio
 import os
 import sys
+from types import SimpleNamespace
 from dotenv import load_dotenv
 
 # Get the absolute path of the current file's directory
@@ -15,6 +16,7 @@ parent_dir = os.path.abspath(os.path.join(current_dir, '..'))
 # Add the parent directory to sys.path
 sys.path.append(parent_dir)
 
+from mcp.types import ServerNotification, ToolListChangedNotification
 from client import MCPClient, parse_vector_string, cosine_similarity
 
 load_dotenv()
@@ -83,6 +85,238 @@ class TestAsyncProcessQuery(unittest.IsolatedAsyncioTestCase):
         self.assertIn("pushups", result.lower())
 
 
+def fake_tools(*names):
+    return SimpleNamespace(tools=[
+        SimpleNamespace(
+            name=name,
+            description=f"Fake {name} tool",
+            inputSchema={"type": "object", "properties": {"location": {"type": "string"}}},
+        )
+        for name in names
+    ])
+
+
+def fake_embedding(text):
+    text = text.lower()
+    # Closest to "time" but below INTENT_THRESHOLD (cosine ~0.77)
+    if "clock" in text:
+        return [0.6, 0.0, 0.5]
+    if "gym" in text or "route" in text:
+        return [0.0, 0.0, 1.0]
+    if "time" in text or "jam" in text:
+        return [1.0, 0.0, 0.0]
+    if "weather" in text or "run" in text or "rain" in text:
+        return [0.0, 1.0, 0.0]
+    return [0.0, 0.0, 1.0]
+
+
+def fake_embeddings(texts):
+    return [fake_embedding(text) for text in texts]
+
+
+def reset_client():
+    client.delete_cache()
+    client.session = None
+    client.tools = []
+    client.tools_signature = None
+    client.tools_stale = True
+    client.cache_failed_signature = None
+    client.cache_retry_at = 0.0
+    client.intent_embeddings = None
+    client.memory = []
+
+
+class TestContextCache(unittest.IsolatedAsyncioTestCase):
+    def make_fake_genai(self):
+        fake_genai = MagicMock()
+        fake_genai.models.generate_content.return_value.text = "Do 10 pushups daily"
+        return fake_genai
+
+    def connect(self, fake_genai, *tool_names):
+        fake_session = MagicMock()
+        fake_session.list_tools = AsyncMock(return_value=fake_tools(*tool_names))
+        client.genai_client = fake_genai
+        client.session = fake_session
+        client.memory = []
+        return fake_session
+
+    # Queries below deliberately miss the time/weather router so they reach the main call
+    @patch("client.MCPClient.embed_results", new_callable=AsyncMock, side_effect=fake_embeddings)
+    @patch("client.MCPClient.embed_result", new_callable=AsyncMock, side_effect=fake_embedding)
+    @patch("client.MCPClient.fetch_ltm", new_callable=AsyncMock, return_value=[])
+    async def test_cache_reused_and_invalidated_on_tool_change(self, mock_fetch, mock_embed, mock_embed_batch):
+        fake_genai = self.make_fake_genai()
+        fake_genai.caches.create.side_effect = [
+            SimpleNamespace(name="cachedContents/first"),
+            SimpleNamespace(name="cachedContents/second"),
+        ]
+        fake_session = self.connect(fake_genai, "get_current_time")
+        try:
+            await client.process_query("best arm exercise", channel_id="test")
+            await client.process_query("best leg exercise", channel_id="test")
+
+            self.assertEqual(fake_session.list_tools.await_count, 1)
+            self.assertEqual(fake_genai.caches.create.call_count, 1)
+            main_config = fake_genai.models.generate_content.call_args.kwargs["config"]
+            self.assertEqual(main_config.cached_content, "cachedContents/first")
+            self.assertIsNone(main_config.system_instruction)
+            self.assertIsNone(main_config.tools)
+
+            fake_session.list_tools.return_value = fake_tools("get_current_time", "get_current_weather")
+            await client.handle_message(ServerNotification(ToolListChangedNotification()))
+            await client.process_query("best core exercise", channel_id="test")
+
+            self.assertEqual(fake_session.list_tools.await_count, 2)
+            self.assertEqual(fake_genai.caches.create.call_count, 2)
+            fake_genai.caches.delete.assert_called_once_with(name="cachedContents/first")
+            main_config = fake_genai.models.generate_content.call_args.kwargs["config"]
+            self.assertEqual(main_config.cached_content, "cachedContents/second")
+        finally:
+            reset_client()
+
+    async def test_cache_disabled_after_too_small_error(self):
+        fake_genai = self.make_fake_genai()
+        fake_genai.caches.create.side_effect = Exception(
+            "400 INVALID_ARGUMENT. Cached content is too small. total_token_count=812, min_total_token_count=1024"
+        )
+        self.connect(fake_genai, "get_current_time")
+        try:
+            await client.sync_tools()
+            self.assertIsNone(client.get_cache())
+            self.assertIsNone(client.get_cache())
+            self.assertEqual(fake_genai.caches.create.call_count, 1)
+        finally:
+            reset_client()
+
+    @patch("client.MCPClient.embed_results", new_callable=AsyncMock, side_effect=fake_embeddings)
+    @patch("client.MCPClient.embed_result", new_callable=AsyncMock, side_effect=fake_embedding)
+    @patch("client.MCPClient.fetch_ltm", new_callable=AsyncMock, return_value=[])
+    async def test_cached_call_failure_retries_inline(self, mock_fetch, mock_embed, mock_embed_batch):
+        fake_genai = self.make_fake_genai()
+        fake_genai.caches.create.return_value = SimpleNamespace(name="cachedContents/gone")
+        inline_response = MagicMock(text="Do 10 pushups daily")
+
+        def generate_content(**kwargs):
+            if kwargs.get("config") is not None and kwargs["config"].cached_content:
+                raise Exception("404 NOT_FOUND. CachedContent not found")
+            return inline_response
+
+        fake_genai.models.generate_content.side_effect = generate_content
+        self.connect(fake_genai, "get_current_time")
+        try:
+            result = await client.process_query("best arm exercise", channel_id="test")
+            self.assertEqual(result, "Do 10 pushups daily")
+            fake_genai.caches.delete.assert_called_once_with(name="cachedContents/gone")
+            self.assertIsNone(client.cache_name)
+            main_config = fake_genai.models.generate_content.call_args.kwargs["config"]
+            self.assertIsNone(main_config.cached_content)
+            self.assertIsNotNone(main_config.system_instruction)
+        finally:
+            reset_client()
+
+    @patch("client.MCPClient.embed_results", new_callable=AsyncMock, side_effect=fake_embeddings)
+    @patch("client.MCPClient.embed_result", new_callable=AsyncMock, side_effect=fake_embedding)
+    @patch("client.MCPClient.fetch_ltm", new_callable=AsyncMock, return_value=[])
+    async def test_failed_tool_resync_keeps_current_tools(self, mock_fetch, mock_embed, mock_embed_batch):
+        fake_genai = self.make_fake_genai()
+        fake_genai.caches.create.return_value = SimpleNamespace(name="cachedContents/first")
+        fake_session = self.connect(fake_genai, "get_current_time")
+        try:
+            await client.sync_tools()
+            tools = client.tools
+            client.tools_stale = True
+            fake_session.list_tools.side_effect = Exception("server busy")
+
+            result = await client.process_query("best arm exercise", channel_id="test")
+            self.assertEqual(result, "Do 10 pushups daily")
+            self.assertIs(client.tools, tools)
+            self.assertTrue(client.tools_stale)
+        finally:
+            reset_client()
+
+    async def test_cache_retried_after_transient_error(self):
+        fake_genai = self.make_fake_genai()
+        fake_genai.caches.create.side_effect = [
+            Exception("503 UNAVAILABLE"),
+            SimpleNamespace(name="cachedContents/retry"),
+        ]
+        self.connect(fake_genai, "get_current_time")
+        try:
+            await client.sync_tools()
+            self.assertIsNone(client.get_cache())
+            self.assertIsNone(client.get_cache())
+            self.assertEqual(fake_genai.caches.create.call_count, 1)
+
+            client.cache_retry_at = 0.0
+            self.assertEqual(client.get_cache(), "cachedContents/retry")
+        finally:
+            reset_client()
+
+
+class TestIntentRouter(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.fake_genai = MagicMock()
+        self.fake_genai.models.generate_content.return_value.text = "It is a good time to run"
+        self.fake_genai.caches.create.return_value = SimpleNamespace(name="cachedContents/router")
+        self.fake_session = MagicMock()
+        self.fake_session.list_tools = AsyncMock(return_value=fake_tools("get_current_time", "get_current_weather"))
+        self.fake_session.call_tool = AsyncMock(return_value=SimpleNamespace(content=[SimpleNamespace(text="ok")]))
+
+        client.genai_client = self.fake_genai
+        client.session = self.fake_session
+        client.memory = []
+        client.intent_embeddings = None
+        client.route_counts = {"time": 0, "weather": 0, "chain": 0}
+
+    def tearDown(self):
+        reset_client()
+
+    @patch("client.MCPClient.embed_results", new_callable=AsyncMock, side_effect=fake_embeddings)
+    @patch("client.MCPClient.embed_result", new_callable=AsyncMock, side_effect=fake_embedding)
+    @patch("client.MCPClient.fetch_ltm", new_callable=AsyncMock, return_value=[])
+    async def test_fast_path_skips_rewrite_chain(self, mock_fetch, mock_embed, mock_embed_batch):
+        result = await client.process_query("what time is it in Jakarta", channel_id="test")
+        self.assertEqual(result, "It is a good time to run")
+        self.fake_session.call_tool.assert_awaited_once_with("get_current_time", {"location": "Asia/Jakarta"})
+        self.assertEqual(self.fake_genai.models.generate_content.call_count, 1)
+
+        self.fake_session.call_tool.reset_mock()
+        await client.process_query("should I run in Yogyakarta now", channel_id="test")
+        self.fake_session.call_tool.assert_any_await("get_current_weather", {"location": "Yogyakarta"})
+        self.assertEqual(self.fake_genai.models.generate_content.call_count, 2)
+
+        # A known city without "in" still picks its own timezone
+        self.fake_session.call_tool.reset_mock()
+        await client.process_query("Makassar time now", channel_id="test")
+        self.fake_session.call_tool.assert_awaited_once_with("get_current_time", {"location": "Asia/Makassar"})
+
+        # Forecast questions still go through the full chain
+        await client.process_query("should I run in Yogyakarta tomorrow", channel_id="test")
+        self.assertEqual(client.route_counts, {"time": 2, "weather": 1, "chain": 1})
+        # All intent examples are embedded in one batched call
+        self.assertEqual(mock_embed_batch.await_count, 1)
+
+    @patch("client.MCPClient.embed_results", new_callable=AsyncMock, side_effect=fake_embeddings)
+    @patch("client.MCPClient.embed_result", new_callable=AsyncMock, side_effect=fake_embedding)
+    @patch("client.MCPClient.fetch_ltm", new_callable=AsyncMock, return_value=[])
+    async def test_near_misses_use_full_chain(self, mock_fetch, mock_embed, mock_embed_batch):
+        for query in [
+            "what time is it in London",
+            "should I run in Yogyakarta now or do a gym session instead?",
+            "should I do a solo run outside now",
+            "is it raining in Jakarta or Bandung now",
+            "is my clock right",
+        ]:
+            await client.process_query(query, channel_id="test")
+
+        # The user's city may be in memory, so don't default to Jakarta time
+        client.insert_stm(np.ones(3), "Running in Jayapura now")
+        await client.process_query("what time is it now", channel_id="test")
+
+        self.fake_session.call_tool.assert_not_awaited()
+        self.assertEqual(client.route_counts, {"time": 0, "weather": 0, "chain": 6})
+
+
 if __name__ == "__main__":
     unittest.main()
 